@@ -0,0 +1,233 @@
+"""
+Shared dbt Helpers
+==================
+
+Helpers shared by the dbt DAGs in this folder. Parsed manifests are kept in
+a process-global cache keyed by manifest path, so DAG files for the same dbt
+project that are parsed by one scheduler or worker process share a single
+parse. Across processes, an Airflow Variable points at a cached copy of the
+last manifest built from the current project sources.
+
+This module defines no DAGs and is listed in .airflowignore.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Directories whose contents determine the manifest, relative to the project
+DBT_SOURCE_DIRS = ("models", "macros", "snapshots", "seeds", "tests", "analyses")
+
+log = logging.getLogger(__name__)
+
+# manifest path -> (mtime when parsed, parsed manifest)
+_MANIFESTS: Dict[str, Tuple[Optional[float], Dict]] = {}
+
+# (manifest path, resource type) -> (mtime when parsed, matching nodes)
+_MANIFEST_NODES: Dict[Tuple[str, str], Tuple[Optional[float], Dict]] = {}
+
+
+def get_manifest(manifest_path: str, project_dir: str) -> Dict:
+    """
+    Return the parsed dbt manifest for a project.
+
+    The result is cached per process and only reloaded when the file's
+    modification time changes. Treat the returned dict as read-only.
+
+    Args:
+        manifest_path: Path to the project's manifest.json
+        project_dir: dbt project directory the manifest was built from
+
+    Returns:
+        Parsed manifest, or {"nodes": {}} when none is available
+    """
+    mtime = _get_mtime(manifest_path)
+    cached = _MANIFESTS.get(manifest_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        source = get_cached_manifest_path(manifest_path, project_dir)
+        manifest = parse_manifest_bytes(Path(source).read_bytes())
+    except FileNotFoundError:
+        manifest = {"nodes": {}}
+    _MANIFESTS[manifest_path] = (mtime, manifest)
+    return manifest
+
+
+def get_manifest_nodes(
+    manifest_path: str, project_dir: str, resource_type: str = "model"
+) -> Dict:
+    """
+    Return the manifest's nodes of one resource type, keyed by unique id.
+
+    When ijson is installed the ``nodes`` object is streamed from disk and
+    only matching nodes are kept, so the rest of the manifest (macros, docs,
+    sources, parent/child maps) is never held in memory. Without ijson the
+    full manifest is parsed and filtered. The file is picked the same way as
+    for get_manifest(), and results are cached per process until it changes.
+
+    Args:
+        manifest_path: Path to the project's manifest.json
+        project_dir: dbt project directory the manifest was built from
+        resource_type: dbt resource type to keep (model, seed, snapshot, test)
+
+    Returns:
+        Matching nodes, or {} when no manifest is available
+    """
+    mtime = _get_mtime(manifest_path)
+    key = (manifest_path, resource_type)
+    cached = _MANIFEST_NODES.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    full = _MANIFESTS.get(manifest_path)
+    if full is not None and full[0] == mtime:
+        node_items = full[1]["nodes"].items()
+        nodes = {k: v for k, v in node_items if v.get("resource_type") == resource_type}
+    else:
+        try:
+            source = get_cached_manifest_path(manifest_path, project_dir)
+            nodes = _stream_manifest_nodes(source, resource_type)
+        except FileNotFoundError:
+            nodes = {}
+    _MANIFEST_NODES[key] = (mtime, nodes)
+    return nodes
+
+
+def _get_mtime(path: str) -> Optional[float]:
+    """Modification time of ``path``, or None when it doesn't exist."""
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+
+def _stream_manifest_nodes(manifest_path: str, resource_type: str) -> Dict:
+    """Read matching nodes from ``manifest_path``, streaming with ijson if available."""
+    try:
+        import ijson
+    except ImportError:
+        manifest = parse_manifest_bytes(Path(manifest_path).read_bytes())
+        return {
+            k: v for k, v in manifest["nodes"].items()
+            if v.get("resource_type") == resource_type
+        }
+
+    with open(manifest_path, "rb") as f:
+        return {
+            k: v for k, v in ijson.kvitems(f, "nodes", use_float=True)
+            if v.get("resource_type") == resource_type
+        }
+
+
+def get_cached_manifest_path(manifest_path: str, project_dir: str) -> str:
+    """
+    Return the file to read the project's manifest from.
+
+    The Airflow Variable ``dbt_manifest_<project>`` records the checksum of
+    the project sources a manifest was built from and the path of its cached
+    copy (see cache_manifest()). That copy is used while the checksum still
+    matches the project; otherwise ``manifest_path`` is read directly. The
+    Variable is only read here, never written, so parsing doesn't write to
+    the metadata database.
+    """
+    from airflow.models import Variable
+
+    cached = Variable.get(_manifest_variable(project_dir), default_var=None, deserialize_json=True) or {}
+    cached_path = cached.get("path")
+    if (
+        cached_path
+        and os.path.exists(cached_path)
+        and cached.get("checksum") == get_project_checksum(project_dir)
+    ):
+        return cached_path
+    return manifest_path
+
+
+def cache_manifest(manifest_path: str, project_dir: str, cache_dir: str) -> None:
+    """
+    Copy a freshly built manifest into ``cache_dir`` and record it in the
+    project's Airflow Variable for get_cached_manifest_path().
+
+    Meant to run in a task right after dbt writes the manifest. A manifest
+    older than the project sources was built from earlier sources, so it
+    is left uncached.
+    """
+    from airflow.models import Variable
+
+    if os.path.getmtime(manifest_path) < get_project_mtime(project_dir):
+        log.info("%s is older than the dbt project sources; not caching it", manifest_path)
+        return
+    checksum = get_project_checksum(project_dir)
+    cached_path = os.path.join(cache_dir, "manifest.json")
+    os.makedirs(cache_dir, exist_ok=True)
+    copy_file_atomic(manifest_path, cached_path)
+    Variable.set(
+        _manifest_variable(project_dir),
+        {"checksum": checksum, "path": cached_path},
+        serialize_json=True,
+    )
+
+
+def _manifest_variable(project_dir: str) -> str:
+    """Name of the Variable recording the project's cached manifest."""
+    return f"dbt_manifest_{Path(project_dir).name}"
+
+
+def copy_file_atomic(src: str, dst: str) -> bool:
+    """
+    Copy ``src`` to ``dst`` through a temporary file renamed into place, so
+    readers of ``dst`` never see a partly written file.
+
+    Returns:
+        False if ``src`` doesn't exist
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), prefix=".tmp_")
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+    except FileNotFoundError:
+        return False
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return True
+
+
+def parse_manifest_bytes(data: bytes) -> Dict:
+    """Decode manifest JSON with orjson when installed, else stdlib json."""
+    try:
+        import orjson
+    except ImportError:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+def get_project_checksum(project_dir: str) -> str:
+    """SHA256 of dbt_project.yml and every file in the project's source dirs."""
+    project = Path(project_dir)
+    digest = hashlib.sha256()
+    for file in _project_files(project):
+        digest.update(str(file.relative_to(project)).encode())
+        digest.update(file.read_bytes())
+    return digest.hexdigest()
+
+
+def get_project_mtime(project_dir: str) -> float:
+    """Latest modification time of the files hashed by get_project_checksum()."""
+    return max((f.stat().st_mtime for f in _project_files(Path(project_dir))), default=0.0)
+
+
+def _project_files(project: Path) -> List[Path]:
+    """dbt_project.yml and the files in the project's source dirs, in a stable order."""
+    files = [project / "dbt_project.yml"]
+    for source_dir in DBT_SOURCE_DIRS:
+        files.extend(sorted(p for p in (project / source_dir).rglob("*") if p.is_file()))
+    return [f for f in files if f.exists()]
@@ -13,36 +13,151 @@ data warehouse with enterprise-grade features:
 - Automatic retries with exponential backoff
 
 Architecture:
-    [Seeds] → [Snapshots] → [Source] → [Staging] → [Quality Check] → [Mart] → [Tests]
+    [Source] → [Staging] → [Quality Check] → [Mart] → [Tests]
+    [Source] → [Snapshots]
+    [Seeds] → [Reference Dimensions]
 
 Author: Data Engineering Team
 Version: 2.0.0
 """
 
 import os
-import json
-from datetime import datetime, timedelta
-from typing import Dict, List
+import logging
+import functools
+import shutil
+import signal
+import subprocess
+import tempfile
+from datetime import timedelta
+from typing import Dict, List, Tuple
 
 import pendulum
 from airflow import DAG
-from airflow.operators.bash import BashOperator
-from airflow.operators.python import PythonOperator, BranchPythonOperator
+from airflow.datasets import Dataset
+from airflow.exceptions import (
+    AirflowException,
+    AirflowFailException,
+    AirflowSensorTimeout,
+    AirflowSkipException,
+)
 from airflow.operators.empty import EmptyOperator
+from airflow.operators.python import PythonOperator
+from airflow.providers.common.sql.sensors.sql import SqlSensor
+from airflow.timetables.datasets import DatasetOrTimeSchedule
+from airflow.timetables.interval import CronDataIntervalTimetable
 from airflow.utils.task_group import TaskGroup
-from airflow.models import Variable
+from airflow.utils.dag_parsing_context import get_parsing_context
+
+from _dbt_common import cache_manifest, copy_file_atomic, get_manifest, get_manifest_nodes
+
+log = logging.getLogger(__name__)
 
 # =============================================================================
 # Configuration
 # =============================================================================
 
+DAG_ID = 'employee_analytics_pipeline'
+
 PROJECT_ROOT = "/Applications/MAMP/htdocs/DataEngineeringAcademy/DBT+Airflow"
 DBT_PROJECT_PATH = os.path.join(PROJECT_ROOT, "dbt/employee_analytics")
 DBT_VENV_PATH = os.path.join(PROJECT_ROOT, "dbt/demo_dbt_env")
 MANIFEST_PATH = os.path.join(DBT_PROJECT_PATH, "target/manifest.json")
 
-# dbt command prefix with virtual environment activation
-DBT_CMD_PREFIX = f"source {DBT_VENV_PATH}/bin/activate && cd {DBT_PROJECT_PATH}"
+# Raw employee data landed by the upstream HR ingestion; an update to it
+# triggers a run without waiting for the daily schedule
+EMPLOYEES_RAW_DATASET = Dataset("postgres://localhost:5432/dw/dev/employees_raw")
+
+# Published when the mart layer is built, for data-aware downstream DAGs
+EMPLOYEE_HISTORY_DATASET = Dataset("postgres://localhost:5432/dw/dev/fact_employee_history")
+
+# Airflow pool bounding concurrent dbt tasks against the warehouse.
+# Create it with: airflow pools set dbt_warehouse 4 'dbt concurrency limit'
+DBT_POOL = "dbt_warehouse"
+
+# dbt worker threads for invocations that build several models at once
+DBT_THREADS = 4
+
+# dbt profile/target passed explicitly so partial parse state stays valid
+DBT_PROFILE = "employee_analytics"
+DBT_TARGET = "dev"
+
+# Flags shared by every dbt invocation, appended after the subcommand
+DBT_COMMON_ARGS = (
+    "--profile", DBT_PROFILE,
+    "--target", DBT_TARGET,
+    "--no-populate-cache",
+    "--no-send-anonymous-usage-stats",
+)
+
+# Cache dir that keeps dbt's partial parse state between tasks, so a task
+# starting on a fresh worker (or with a cleaned target/) skips a full parse,
+# and the copy of the manifest the DAG reads while parsing
+DBT_TARGET_DIR = os.path.join(DBT_PROJECT_PATH, "target")
+DBT_CACHE_DIR = os.path.join(PROJECT_ROOT, "dbt/.dbt_cache")
+PARTIAL_PARSE_FILE = "partial_parse.msgpack"
+
+# Per-run scratch dir, on tmpfs where available so dbt's artifacts never hit
+# disk and a run never picks up artifacts left by an earlier one. Each task
+# gets its own target dir inside it, since tasks of a run execute in
+# parallel. Both contain templates, so they can only be used in templated
+# fields such as op_kwargs.
+DBT_RUN_TARGET_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+DBT_RUN_DIR = os.path.join(DBT_RUN_TARGET_ROOT, "dbt_{{ run_id }}")
+DBT_RUN_TARGET_PATH = os.path.join(DBT_RUN_DIR, "{{ task.task_id }}")
+
+# Manifest of the last successful run, compared against for state:modified
+DBT_STATE_DIR = os.path.join(DBT_CACHE_DIR, "state")
+
+# Warehouse connection and threshold for the data quality gate probe
+DW_CONN_ID = "dw_postgres"
+QUALITY_PROBE_SQL = "SELECT COUNT(*) FROM dev.employees_current"
+MIN_EMPLOYEE_ROWS = 1
+
+# The gate polls in poke mode: its interval is far shorter than the cost of
+# rescheduling onto a fresh worker. Use mode='reschedule' only for sensors
+# polling every 5 minutes or more.
+QUALITY_GATE_POKE_INTERVAL = 30
+QUALITY_GATE_TIMEOUT = 600
+
+# Environment that puts the dbt virtualenv first on PATH; merged into the
+# dbt process environment so commands don't have to source bin/activate
+DBT_ENV = {
+    "VIRTUAL_ENV": DBT_VENV_PATH,
+    "PATH": f"{DBT_VENV_PATH}/bin:{os.environ.get('PATH', '')}",
+    "DBT_PARTIAL_PARSE": "true",
+}
+
+# Selectors for each model layer. The model folders are tagged in
+# dbt_project.yml, so new models there are picked up automatically.
+SOURCE_SELECTOR = "tag:source"
+# Seeds plus the dimensions built only from them (tagged in mart/schema.yml);
+# they don't depend on the day's employee data, so they stay off the mart path
+REFERENCE_SELECTOR = "resource_type:seed tag:reference"
+# The same nodes, limited to those changed since the saved state
+REFERENCE_STATE_SELECTOR = " ".join(
+    f"{selector},state:modified+" for selector in REFERENCE_SELECTOR.split()
+)
+STAGING_SELECTOR = "tag:staging"
+MART_SELECTOR = "tag:mart tag:audit"
+
+# dbt output that marks a failure retries can't fix (bad SQL/Jinja). Tasks
+# hitting one fail immediately instead of retrying. Only the error summary
+# dbt prints at the end is searched, not logs of nodes that later succeeded.
+# "Database Error" is left out on purpose: dbt reports a missing column or
+# relation the same way as a dropped connection, a deadlock or a lock
+# timeout, and those are worth retrying. Failing fast on a bad query isn't
+# worth giving up retries on those.
+DBT_DETERMINISTIC_ERRORS = ("Compilation Error", "Parsing Error")
+DBT_ERROR_SUMMARY_MARKERS = ("Completed with", "Encountered an error")
+
+# Seconds dbt gets to cancel its queries after an interrupt before it is killed
+DBT_KILL_TIMEOUT = 30
+
+# Environment for date-partitioned models, read with env_var('EXECUTION_DATE');
+# '{{ ds }}' is rendered by Airflow. Unlike --vars, a changed env var only
+# makes dbt re-parse the files that use it, so partial parsing stays effective.
+# Every dbt task gets it, so all of a run's invocations parse the same value.
+EXECUTION_DATE_ENV = {'EXECUTION_DATE': '{{ ds }}'}
 
 # Default arguments for all tasks
 DEFAULT_ARGS = {
@@ -56,52 +171,298 @@ DEFAULT_ARGS = {
     'retry_exponential_backoff': True,
     'max_retry_delay': timedelta(minutes=30),
     'execution_timeout': timedelta(hours=1),
+    'priority_weight': 10,
+    'weight_rule': 'absolute',
 }
 
+# Tasks on the critical path (raw load -> staging -> quality gate -> mart ->
+# tests) are queued ahead of off-path work (reference data, snapshots,
+# freshness, docs) when pool slots are scarce
+CRITICAL_PATH_PRIORITY = {'priority_weight': 100}
+
 # =============================================================================
 # Helper Functions
 # =============================================================================
 
 def load_manifest() -> Dict:
-    """Load dbt manifest.json file."""
-    if not os.path.exists(MANIFEST_PATH):
+    """
+    Load dbt manifest.json file.
+
+    Parsing is shared with other DAG files through _dbt_common.get_manifest(),
+    which caches per process and, via an Airflow Variable, across workers.
+    Treat the returned dict as read-only.
+
+    When Airflow parses this file only to run a task of another DAG, the
+    manifest is not needed and an empty one is returned without touching disk.
+    """
+    if get_parsing_context().dag_id not in (None, DAG_ID):
         return {"nodes": {}}
-    with open(MANIFEST_PATH) as f:
-        return json.load(f)
+    return get_manifest(MANIFEST_PATH, DBT_PROJECT_PATH)
 
 
-def get_dbt_command(command: str, model: str = None, vars: Dict = None) -> str:
+def load_manifest_nodes(resource_type: str = "model") -> Dict:
+    """
+    Load only the manifest nodes of one resource type (models by default).
+
+    Prefer this over load_manifest() when only node metadata is needed:
+    the nodes are streamed from manifest.json, so the full manifest is
+    never held in memory.
     """
-    Generate a dbt command with proper formatting.
+    if get_parsing_context().dag_id not in (None, DAG_ID):
+        return {}
+    return get_manifest_nodes(MANIFEST_PATH, DBT_PROJECT_PATH, resource_type)
+
+
+@functools.lru_cache(maxsize=None)
+def get_dbt_command(
+    command: str,
+    model: str = None,
+    threads: int = None,
+    write_json: bool = False,
+    exclude: str = None,
+    fail_fast: bool = False,
+    state: bool = False,
+) -> Tuple[str, ...]:
+    """
+    Generate the argv for a dbt command.
+    
+    Results are memoized, so all arguments must be hashable. The argv is
+    executed directly rather than through a shell, so no quoting is needed.
     
     Args:
         command: dbt command (run, test, snapshot, seed)
         model: Optional model selector
-        vars: Optional variables to pass
+        threads: Optional number of dbt threads
+        write_json: Write manifest.json/run_results.json to target/
+        exclude: Optional exclusion selector
+        fail_fast: Stop at the first failing node
+        state: Compare against the manifest saved in DBT_STATE_DIR
     
     Returns:
-        Full bash command string
+        dbt argv as a tuple
     """
-    cmd = f"{DBT_CMD_PREFIX} && dbt {command}"
+    args = ["dbt", *command.split(), *DBT_COMMON_ARGS]
+    
+    if not write_json:
+        args.append("--no-write-json")
     
     if model:
-        cmd += f" --select {model}"
+        args += ["--select", *model.split()]
+    
+    if exclude:
+        args += ["--exclude", *exclude.split()]
     
-    if vars:
-        vars_str = json.dumps(vars).replace('"', '\\"')
-        cmd += f' --vars "{vars_str}"'
+    if threads:
+        args += ["--threads", str(threads)]
     
-    return cmd
+    if fail_fast:
+        args.append("--fail-fast")
+    
+    if state:
+        args += ["--state", DBT_STATE_DIR]
+    
+    return tuple(args)
+
+
+def dbt_task(
+    task_id: str,
+    command: str,
+    model: str = None,
+    env: Dict[str, str] = None,
+    threads: int = None,
+    write_json: bool = False,
+    exclude: str = None,
+    fail_fast: bool = False,
+    state_model: str = None,
+    target_path: str = DBT_RUN_TARGET_PATH,
+    allow_failure: bool = False,
+    **kwargs,
+) -> PythonOperator:
+    """
+    Create a task that runs a single dbt command.
+
+    Every dbt invocation in this DAG is built here, so execution settings
+    shared by all dbt tasks only need to be changed in one place. Tasks
+    share the warehouse pool.
+
+    Args:
+        task_id: Airflow task id
+        command: dbt command (run, test, snapshot, seed)
+        model: Optional model selector
+        env: Optional environment for dbt on top of EXECUTION_DATE_ENV;
+            values are templated
+        threads: Optional number of dbt threads
+        write_json: Write manifest.json/run_results.json to target/
+        exclude: Optional exclusion selector
+        fail_fast: Stop at the first failing node
+        state_model: Selector used instead of ``model`` once a saved state
+            manifest exists
+        target_path: dbt target dir, the task's own dir in the run's scratch
+            dir by default
+        allow_failure: Don't fail the task when dbt exits non-zero
+        **kwargs: Passed through to the operator
+
+    Returns:
+        Operator running the dbt command
+    """
+    args = get_dbt_command(
+        command, model, threads, write_json, exclude, fail_fast
+    )
+    op_kwargs = {
+        'args': list(args),
+        'target_path': target_path,
+        'env': {**EXECUTION_DATE_ENV, **(env or {})},
+        'allow_failure': allow_failure,
+    }
+    if state_model:
+        state_args = get_dbt_command(
+            command, state_model, threads, write_json, exclude, fail_fast,
+            state=True,
+        )
+        op_kwargs['state_args'] = list(state_args)
+    return PythonOperator(
+        task_id=task_id,
+        python_callable=run_dbt_command,
+        op_kwargs=op_kwargs,
+        pool=DBT_POOL,
+        **kwargs,
+    )
+
+
+def remove_dbt_run_dir(run_dir: str) -> None:
+    """Delete a run's scratch dir, including every task's dbt target dir."""
+    shutil.rmtree(run_dir, ignore_errors=True)
 
 
-def check_data_quality(**context) -> str:
+def copy_partial_parse_state(src_dir: str, dst_dir: str) -> None:
+    """Copy dbt's partial parse file between directories, if it exists."""
+    os.makedirs(dst_dir, exist_ok=True)
+    copy_file_atomic(
+        os.path.join(src_dir, PARTIAL_PARSE_FILE),
+        os.path.join(dst_dir, PARTIAL_PARSE_FILE),
+    )
+
+
+def run_dbt_command(
+    args: List[str],
+    target_path: str = DBT_TARGET_DIR,
+    env: Dict[str, str] = None,
+    allow_failure: bool = False,
+    state_args: List[str] = None,
+) -> str:
+    """
+    Run a dbt command, streaming its output to the task log.
+
+    ``state_args`` replaces ``args`` when a state manifest has been saved;
+    until the first successful run the full selection is built.
+
+    The partial parse state is restored into ``target_path`` before dbt
+    starts and saved back to the cache directory after a successful run.
+
+    Failures whose error summary matches DBT_DETERMINISTIC_ERRORS raise
+    AirflowFailException, which fails the task without using its remaining
+    retries; any other non-zero exit is raised as a normal, retryable error.
+
+    If the task is interrupted (timeout, kill), dbt gets SIGINT so it cancels
+    its running queries, and is killed if it hasn't exited in time.
+
+    Returns:
+        Last line of output, pushed to XCom like BashOperator does
+    """
+    if state_args and os.path.exists(os.path.join(DBT_STATE_DIR, "manifest.json")):
+        args = state_args
+    copy_partial_parse_state(DBT_CACHE_DIR, target_path)
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        env={**os.environ, **DBT_ENV, **(env or {}), "DBT_TARGET_PATH": target_path},
+        cwd=DBT_PROJECT_PATH,
+    )
+
+    last_line = None
+    in_summary = False
+    deterministic_error = None
+    try:
+        for line in process.stdout:
+            last_line = line.rstrip()
+            log.info(last_line)
+            if not in_summary:
+                in_summary = any(m in last_line for m in DBT_ERROR_SUMMARY_MARKERS)
+            if in_summary and deterministic_error is None:
+                deterministic_error = next(
+                    (err for err in DBT_DETERMINISTIC_ERRORS if err in last_line), None
+                )
+        returncode = process.wait()
+    finally:
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=DBT_KILL_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    if returncode == 0:
+        copy_partial_parse_state(target_path, DBT_CACHE_DIR)
+    elif allow_failure:
+        log.warning("dbt exited with code %s; ignoring", returncode)
+    elif deterministic_error:
+        raise AirflowFailException(
+            f"dbt failed with '{deterministic_error}'; not retrying"
+        )
+    else:
+        raise AirflowException(f"dbt command failed with exit code {returncode}")
+    return last_line
+
+
+def save_dbt_state(manifest_dir: str) -> None:
+    """
+    Keep the reference build's manifest as the state for the next run.
+
+    The manifest is the one dbt wrote while building the reference data, so
+    the state holds exactly what was built.
+    """
+    os.makedirs(DBT_STATE_DIR, exist_ok=True)
+    manifest = os.path.join(manifest_dir, "manifest.json")
+    if not copy_file_atomic(manifest, os.path.join(DBT_STATE_DIR, "manifest.json")):
+        log.info("No manifest in %s; reference data wasn't built", manifest_dir)
+
+
+def fail_run() -> None:
+    """
+    Fail the DAG run.
+    Runs only when a task upstream of it failed, so a failure anywhere fails
+    the run even when trigger rules skip the tasks after it.
+    """
+    raise AirflowFailException("An upstream task failed")
+
+
+def check_data_quality(row_count) -> bool:
     """
     Check data quality after staging models complete.
-    Returns the next task group to execute based on quality checks.
+    Returns True once the merged employee table holds enough rows.
+
+    Used as the ``success`` criterion of the quality gate sensor, which
+    passes in the first cell of QUALITY_PROBE_SQL.
+    """
+    return row_count is not None and int(row_count) >= MIN_EMPLOYEE_ROWS
+
+
+class QualityGateSensor(SqlSensor):
+    """
+    SqlSensor that is skipped when it times out waiting for enough rows.
+
+    Unlike soft_fail, which also skips on errors such as a broken connection
+    or a missing table, any other error fails the gate, so it isn't reported
+    as a failed quality check.
     """
-    # In production, this would query actual data quality metrics
-    # For now, we always proceed
-    return 'mart_models.start_mart'
+
+    def execute(self, context):
+        try:
+            return super().execute(context)
+        except AirflowSensorTimeout as e:
+            raise AirflowSkipException(f"Data quality gate not passed: {e}") from e
 
 
 def notify_failure(context):
@@ -151,217 +512,258 @@ def notify_success(context):
 # DAG Definition
 # =============================================================================
 
-with DAG(
-    dag_id='employee_analytics_pipeline',
-    description='Production-ready dbt pipeline for Employee Analytics warehouse',
-    default_args=DEFAULT_ARGS,
-    start_date=pendulum.datetime(2022, 9, 1, tz='UTC'),
-    schedule_interval='0 6 * * *',  # Daily at 6 AM UTC
-    catchup=False,
-    max_active_runs=1,
-    tags=['dbt', 'employee', 'data-warehouse', 'production'],
-    doc_md=__doc__,
-    on_failure_callback=notify_failure,
-    on_success_callback=notify_success,
-) as dag:
-
-    # =========================================================================
-    # Start/End Markers
-    # =========================================================================
-    
-    start = EmptyOperator(task_id='start')
-    end = EmptyOperator(task_id='end', trigger_rule='none_failed')
+def build_dag(dag: DAG) -> None:
+    """
+    Create all task groups, tasks and dependencies on ``dag``.
 
-    # =========================================================================
-    # Task Group: Seeds (Reference Data)
-    # =========================================================================
-    
-    with TaskGroup(group_id='seed_data') as seed_group:
-        
-        seed_start = EmptyOperator(task_id='start_seeds')
-        
-        load_seeds = BashOperator(
-            task_id='load_seeds',
-            bash_command=get_dbt_command('seed'),
-            doc_md="Load reference data (departments, job_titles) from CSV seeds"
-        )
-        
-        seed_end = EmptyOperator(task_id='end_seeds')
-        
-        seed_start >> load_seeds >> seed_end
+    Kept separate from the DAG object so that parses which don't need this
+    DAG's tasks can skip building them entirely.
+    """
+    with dag:
 
-    # =========================================================================
-    # Task Group: Snapshots (SCD Type 2)
-    # =========================================================================
-    
-    with TaskGroup(group_id='snapshots') as snapshot_group:
+        # =====================================================================
+        # Task Group: Seeds (Reference Data)
+        # =====================================================================
         
-        snapshot_start = EmptyOperator(task_id='start_snapshots')
+        with TaskGroup(group_id='seed_data') as seed_group:
+            
+            build_reference = dbt_task(
+                task_id='build_reference_data',
+                command='build',
+                model=REFERENCE_SELECTOR,
+                # Skip unchanged seeds and their dimensions
+                state_model=REFERENCE_STATE_SELECTOR,
+                threads=DBT_THREADS,
+                # The manifest from this build becomes the next run's state
+                write_json=True,
+                doc_md="Load CSV seeds and build the department/job title dimensions from them"
+            )
+
+        # =====================================================================
+        # Task Group: Snapshots (SCD Type 2)
+        # =====================================================================
         
-        run_snapshots = BashOperator(
-            task_id='run_snapshots',
-            bash_command=get_dbt_command('snapshot'),
-            doc_md="Run SCD Type 2 snapshots for historical tracking"
-        )
-        
-        snapshot_end = EmptyOperator(task_id='end_snapshots')
+        with TaskGroup(group_id='snapshots') as snapshot_group:
+            
+            run_snapshots = dbt_task(
+                task_id='run_snapshots',
+                command='snapshot',
+                threads=DBT_THREADS,
+                doc_md="Run SCD Type 2 snapshots for historical tracking"
+            )
+
+        # =====================================================================
+        # Task Group: Source Models
+        # =====================================================================
         
-        snapshot_start >> run_snapshots >> snapshot_end
-
-    # =========================================================================
-    # Task Group: Source Models
-    # =========================================================================
-    
-    with TaskGroup(group_id='source_models') as source_group:
+        with TaskGroup(group_id='source_models') as source_group:
+            
+            source_freshness = dbt_task(
+                task_id='check_source_freshness',
+                command='source freshness',
+                allow_failure=True,
+                doc_md="Check data freshness of source tables"
+            )
+            
+            stg_employees = dbt_task(
+                task_id='stg_employees_raw',
+                command='run',
+                model=SOURCE_SELECTOR,
+                threads=DBT_THREADS,
+                **CRITICAL_PATH_PRIORITY,
+                doc_md="Load raw employee data into staging"
+            )
+
+        # =====================================================================
+        # Task Group: Staging/Intermediate Models
+        # =====================================================================
         
-        source_start = EmptyOperator(task_id='start_source')
+        with TaskGroup(group_id='staging_models') as staging_group:
+            
+            # One dbt invocation builds the whole layer; dbt runs the models in
+            # parallel threads instead of paying the dbt startup cost per model.
+            # dbt build tests each model as soon as it is built, so the layer's
+            # tests don't need a separate invocation before the quality gate.
+            run_staging = dbt_task(
+                task_id='run_staging_models',
+                command='build',
+                model=STAGING_SELECTOR,
+                threads=DBT_THREADS,
+                fail_fast=True,
+                **CRITICAL_PATH_PRIORITY,
+                doc_md="Build and test the employee dimension (MERGE) and snapshot (DELETE+INSERT) models"
+            )
+
+        # =====================================================================
+        # Task: Data Quality Gate
+        # =====================================================================
         
-        source_freshness = BashOperator(
-            task_id='check_source_freshness',
-            bash_command=f"{DBT_CMD_PREFIX} && dbt source freshness || true",
-            doc_md="Check data freshness of source tables"
+        # On timeout the sensor is skipped, which skips the mart layer; errors
+        # running the probe fail it
+        quality_gate = QualityGateSensor(
+            task_id='data_quality_gate',
+            conn_id=DW_CONN_ID,
+            sql=QUALITY_PROBE_SQL,
+            success=check_data_quality,
+            mode='poke',
+            poke_interval=QUALITY_GATE_POKE_INTERVAL,
+            timeout=QUALITY_GATE_TIMEOUT,
+            exponential_backoff=True,
+            **CRITICAL_PATH_PRIORITY,
+            doc_md="Validate data quality before proceeding to mart layer"
         )
         
-        stg_employees = BashOperator(
-            task_id='stg_employees_raw',
-            bash_command=get_dbt_command(
-                'run', 
-                'stg_employees_raw',
-                {'execution_date': '{{ ds }}'}
-            ),
-            doc_md="Load raw employee data into staging"
+        # Runs only when the gate is skipped and the mart layer with it
+        quality_failed = EmptyOperator(
+            task_id='quality_check_failed',
+            trigger_rule='all_skipped',
+            doc_md="Placeholder for quality failure handling"
         )
-        
-        source_end = EmptyOperator(task_id='end_source')
-        
-        source_start >> source_freshness >> stg_employees >> source_end
 
-    # =========================================================================
-    # Task Group: Staging/Intermediate Models
-    # =========================================================================
-    
-    with TaskGroup(group_id='staging_models') as staging_group:
+        # =====================================================================
+        # Task Group: Mart Models
+        # =====================================================================
         
-        staging_start = EmptyOperator(task_id='start_staging')
+        with TaskGroup(group_id='mart_models') as mart_group:
+            
+            # dbt build runs each model's tests right after the model, within
+            # the same invocation
+            build_mart = dbt_task(
+                task_id='build_mart_models',
+                command='build',
+                model=MART_SELECTOR,
+                exclude="tag:reference",
+                threads=DBT_THREADS,
+                outlets=[EMPLOYEE_HISTORY_DATASET],
+                **CRITICAL_PATH_PRIORITY,
+                doc_md="Build and test the employee history fact and audit log"
+            )
+
+        # =====================================================================
+        # Task Group: Tests
+        # =====================================================================
         
-        int_merged = BashOperator(
-            task_id='int_employees_merged',
-            bash_command=get_dbt_command(
-                'run',
-                'int_employees_merged',
-                {'execution_date': '{{ ds }}'}
-            ),
-            doc_md="Employee dimension using MERGE strategy"
-        )
+        with TaskGroup(group_id='data_tests') as test_group:
+            
+            run_tests = dbt_task(
+                task_id='run_all_tests',
+                command='test',
+                exclude=f"{REFERENCE_SELECTOR} {STAGING_SELECTOR} {MART_SELECTOR}",
+                **CRITICAL_PATH_PRIORITY,
+                doc_md="Run dbt data quality tests not already run by the layer builds"
+            )
+
+        # =====================================================================
+        # Task: Generate Documentation
+        # =====================================================================
         
-        int_snapshot = BashOperator(
-            task_id='int_employees_snapshot',
-            bash_command=get_dbt_command(
-                'run',
-                'int_employees_snapshot',
-                {'execution_date': '{{ ds }}'}
-            ),
-            doc_md="Employee snapshot using DELETE+INSERT strategy"
+        generate_docs = dbt_task(
+            task_id='generate_docs',
+            command='docs generate',
+            write_json=True,
+            # The docs site and the DAG's manifest reads use the project target/
+            target_path=DBT_TARGET_DIR,
+            doc_md="Generate dbt documentation and lineage"
         )
-        
-        staging_end = EmptyOperator(task_id='end_staging')
-        
-        staging_start >> [int_merged, int_snapshot] >> staging_end
 
-    # =========================================================================
-    # Task: Data Quality Gate
-    # =========================================================================
-    
-    quality_gate = BranchPythonOperator(
-        task_id='data_quality_gate',
-        python_callable=check_data_quality,
-        doc_md="Validate data quality before proceeding to mart layer"
-    )
-    
-    quality_failed = EmptyOperator(
-        task_id='quality_check_failed',
-        doc_md="Placeholder for quality failure handling"
-    )
-
-    # =========================================================================
-    # Task Group: Mart Models
-    # =========================================================================
-    
-    with TaskGroup(group_id='mart_models') as mart_group:
-        
-        mart_start = EmptyOperator(task_id='start_mart')
-        
-        fct_history = BashOperator(
-            task_id='fct_employee_history',
-            bash_command=get_dbt_command(
-                'run',
-                'fct_employee_history',
-                {'execution_date': '{{ ds }}'}
-            ),
-            doc_md="Employee history fact table with APPEND strategy"
-        )
-        
-        dim_departments = BashOperator(
-            task_id='dim_departments',
-            bash_command=get_dbt_command('run', 'dim_departments'),
-            doc_md="Department dimension table"
+        # Points the DAG's manifest reads on every worker at the manifest just
+        # generated; kept in a task so parsing never writes the Variable
+        cache_docs_manifest = PythonOperator(
+            task_id='cache_manifest',
+            python_callable=cache_manifest,
+            op_kwargs={
+                'manifest_path': MANIFEST_PATH,
+                'project_dir': DBT_PROJECT_PATH,
+                'cache_dir': DBT_CACHE_DIR,
+            },
+            doc_md="Cache the generated manifest for DAG parsing"
         )
-        
-        dim_job_titles = BashOperator(
-            task_id='dim_job_titles',
-            bash_command=get_dbt_command('run', 'dim_job_titles'),
-            doc_md="Job title dimension table"
+
+        # Saved only when the reference data was built and everything after
+        # the mart layer, docs included, succeeded
+        save_state = PythonOperator(
+            task_id='save_dbt_state',
+            python_callable=save_dbt_state,
+            op_kwargs={'manifest_dir': os.path.join(DBT_RUN_DIR, build_reference.task_id)},
+            doc_md="Save the manifest for state:modified selection in the next run"
         )
-        
-        audit_log = BashOperator(
-            task_id='dbt_audit_log',
-            bash_command=get_dbt_command('run', 'dbt_audit_log'),
-            doc_md="Audit log for tracking runs"
+
+        # Fails the run as soon as any task fails. Trigger rules can skip
+        # everything downstream of a failed task (e.g. when the quality gate
+        # has already skipped the tests), leaving no failed leaf behind.
+        run_failed = PythonOperator(
+            task_id='run_failed',
+            python_callable=fail_run,
+            trigger_rule='one_failed',
+            retries=0,
+            doc_md="Fail the run when any task failed"
         )
-        
-        mart_end = EmptyOperator(task_id='end_mart')
-        
-        mart_start >> [fct_history, dim_departments, dim_job_titles, audit_log] >> mart_end
 
-    # =========================================================================
-    # Task Group: Tests
-    # =========================================================================
-    
-    with TaskGroup(group_id='data_tests') as test_group:
+        # A teardown runs once everything upstream is done, whatever the
+        # outcome, and doesn't count towards the run's state
+        cleanup_target = PythonOperator(
+            task_id='cleanup_dbt_target',
+            python_callable=remove_dbt_run_dir,
+            op_kwargs={'run_dir': DBT_RUN_DIR},
+            doc_md="Remove this run's dbt scratch dir"
+        ).as_teardown()
+
+        # =====================================================================
+        # Task Dependencies
+        # =====================================================================
         
-        test_start = EmptyOperator(task_id='start_tests')
+        # Main flow. Edges follow the dbt ref graph: the reference data is
+        # built from seeds alone and the snapshot only reads stg_employees_raw.
+        # Freshness is informational, so only the raw load gates the next layers
+        stg_employees >> [staging_group, snapshot_group]
+        staging_group >> quality_gate
         
-        run_tests = BashOperator(
-            task_id='run_all_tests',
-            bash_command=get_dbt_command('test'),
-            doc_md="Run all dbt data quality tests"
-        )
+        # Quality gate: a skipped gate skips the mart layer, which in turn
+        # triggers the failure handler
+        quality_gate >> mart_group >> quality_failed
         
-        test_end = EmptyOperator(task_id='end_tests')
+        # Continue after mart. Docs only need the built relations for the
+        # catalog, not passing tests, so they run alongside the test suite.
+        mart_group >> [test_group, generate_docs] >> save_state
+        generate_docs >> cache_docs_manifest
+        snapshot_group >> test_group
+        seed_group >> save_state
         
-        test_start >> run_tests >> test_end
-
-    # =========================================================================
-    # Task: Generate Documentation
-    # =========================================================================
-    
-    generate_docs = BashOperator(
-        task_id='generate_docs',
-        bash_command=get_dbt_command('docs generate'),
-        doc_md="Generate dbt documentation and lineage"
-    )
+        # Every task reading or writing the run's scratch dir is a direct
+        # upstream of the cleanup; a skip or failure elsewhere in the graph
+        # must not let it delete a dir still in use
+        [
+            source_freshness, stg_employees, build_reference, run_snapshots,
+            run_staging, build_mart, run_tests, save_state,
+        ] >> cleanup_target
+        [
+            source_freshness, stg_employees, build_reference, run_snapshots,
+            run_staging, quality_gate, build_mart, run_tests, generate_docs,
+            cache_docs_manifest, save_state,
+        ] >> run_failed
+
+
+dag = DAG(
+    dag_id=DAG_ID,
+    description='Production-ready dbt pipeline for Employee Analytics warehouse',
+    default_args=DEFAULT_ARGS,
+    start_date=pendulum.datetime(2022, 9, 1, tz='UTC'),
+    # When raw data lands, or daily at 6 AM UTC if it hasn't
+    schedule=DatasetOrTimeSchedule(
+        timetable=CronDataIntervalTimetable('0 6 * * *', timezone='UTC'),
+        datasets=[EMPLOYEES_RAW_DATASET],
+    ),
+    catchup=False,
+    # Runs share tables (employees_raw, employees_current) and the project
+    # target/, so they must not overlap
+    max_active_runs=1,
+    tags=['dbt', 'employee', 'data-warehouse', 'production'],
+    doc_md=__doc__,
+    on_failure_callback=notify_failure,
+    on_success_callback=notify_success,
+)
 
-    # =========================================================================
-    # Task Dependencies
-    # =========================================================================
-    
-    # Main flow
-    start >> seed_group >> snapshot_group >> source_group >> staging_group
-    staging_group >> quality_gate
-    
-    # Quality gate branching
-    quality_gate >> [mart_group, quality_failed]
-    quality_failed >> end
-    
-    # Continue after mart
-    mart_group >> test_group >> generate_docs >> end
+# Only build tasks when the whole DagBag is parsed or this DAG is the one
+# being executed; a parse to run another DAG's task gets the bare DAG
+if get_parsing_context().dag_id in (None, DAG_ID):
+    build_dag(dag)
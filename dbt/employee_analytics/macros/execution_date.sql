@@ -0,0 +1,13 @@
+/*
+    Macro: get_execution_date
+    Description: Returns the date an incremental load is for. Airflow passes
+                 it in the EXECUTION_DATE env var; manual runs can set the
+                 execution_date variable instead.
+    
+    Usage:
+        where record_date = '{{ get_execution_date() }}'
+*/
+
+{% macro get_execution_date() %}
+    {{- return(env_var("EXECUTION_DATE", var("execution_date"))) -}}
+{% endmacro %}
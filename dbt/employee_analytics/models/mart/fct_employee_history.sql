@@ -3,13 +3,17 @@
     Layer: Mart/Analytics
     Description: Fact table containing historical employee records.
                  Uses incremental APPEND strategy to maintain full history.
-                 New records are added based on execution_date variable.
+                 New records are added based on the execution date. The
+                 pre-hook first deletes that date's rows, so a rerun for the
+                 same date (e.g. a dataset-triggered run followed by the cron
+                 fallback) replaces them instead of appending duplicates.
     Materialization: Incremental (append)
 */
 
 {{ config(
     materialized='incremental', 
-    alias='fact_employee_history'
+    alias='fact_employee_history',
+    pre_hook="{% if is_incremental() %}delete from {{ this }} where record_date = '{{ get_execution_date() }}'{% endif %}"
 ) }}
 
 with employee_records as (
@@ -26,7 +30,7 @@ with employee_records as (
     from {{ ref('int_employees_merged') }}
 
     {% if is_incremental() %}
-        where record_date = '{{ var("execution_date") }}'
+        where record_date = '{{ get_execution_date() }}'
     {% endif %}
 
 )
@@ -9,7 +9,11 @@
 {{ config(
     materialized='incremental',
     alias='employees_current',
-    unique_key='employee_id'
+    unique_key='employee_id',
+    indexes=[
+        {'columns': ['employee_id']},
+        {'columns': ['record_date']}
+    ]
 ) }}
 
 with transformed as (